@@ -2,17 +2,21 @@
 # Modified from Joan Sala Calero, Deltares, (https://github.com/switchonproject/sip-html5-data-upload).
 
 import requests
+from requests_toolbelt import MultipartEncoder
 import json
 import os
+import shutil
 
 class DOI:
-    def __init__(self, files2push, directory, datasetName, logger=None):
+    def __init__(self, files2push, directory, datasetName, logger=None, bigFileMB=99):
         # Inputs
         self.dataset = datasetName
         self.zapi = "https://zenodo.org/api/deposit/depositions"
         self.logger = logger
         self.direc = directory
         self.files = files2push
+        self.bigFileMB = bigFileMB  # files from this size (MB) on are uploaded via the bucket API
+        self.uploaded = []  # files that are stored on zenodo after runUpload
         # Read token from disk
         with open(os.path.join(os.path.dirname(__file__), 'ztoken.txt')) as f:
             self.ztoken = f.read().strip()
@@ -29,27 +33,72 @@ class DOI:
         }
         return requests.post(self.zapi + "?access_token=" + self.ztoken, data=json.dumps(data), headers={"Content-Type": "application/json"})
 
-    # Upload a single file smaller than 100mb
+    # Upload a single file smaller than the big file threshold
+    # The multipart body is streamed from disk instead of being built in memory
     def zenodoUploadFile(self, url_files, filepath):
         self.logger.info('DOI file upload:' + str(filepath))
-        data = {'filename': os.path.basename(filepath) }
-        files = {'file': open(filepath, 'rb')}
-        return requests.post(url_files + "?access_token=" + self.ztoken, data=data, files=files, timeout=300)
+        filename = os.path.basename(filepath)
+        with open(filepath, 'rb') as f:
+            data = MultipartEncoder(fields={'filename': filename,
+                                            'file': (filename, f, 'application/octet-stream')})
+            return requests.post(url_files + "?access_token=" + self.ztoken, data=data,
+                                 headers={"Content-Type": data.content_type}, timeout=300)
 
-    # Upload a single file bigger than 100mb
+    # Upload a single file bigger than the big file threshold
     def zenodoUploadFileBig(self, url_files, filepath):
         self.logger.info('DOI BIG file upload:' + str(filepath))
-        return requests.put('%s/%s' % (url_files, os.path.basename(filepath)),
-                         data=open(filepath, 'rb'),
-                         headers={"Accept": "application/json",
-                                  "Authorization": "Bearer %s" % self.ztoken,
-                                  "Content-Type": "application/octet-stream"})
+        with open(filepath, 'rb') as f:
+            return requests.put('%s/%s' % (url_files, os.path.basename(filepath)),
+                             data=f,
+                             headers={"Accept": "application/json",
+                                      "Authorization": "Bearer %s" % self.ztoken,
+                                      "Content-Type": "application/octet-stream"})
 
-    # Is file bigger than the threshold of 100mb // Zenodo limitations
+    # Download a file of a deposition back to disk (to restore a staged file that has been evicted).
+    # The file is written to tmppath first (default: next to filepath), which is removed when the download fails.
+    def zenodoDownloadFile(self, deposition_id, filename, filepath, tmppath=None):
+        self.logger.info('DOI file download:' + str(filepath))
+        headers = {"Authorization": "Bearer %s" % self.ztoken}
+        ret = requests.get('%s/%s/files' % (self.zapi, deposition_id), headers=headers, timeout=300)
+        if ret.status_code >= 300:
+            self.logger.error('ERR, listing files of deposition ' + str(deposition_id))
+            return False
+
+        for zfile in ret.json():
+            if zfile['filename'] == filename:
+                if tmppath is None:
+                    tmppath = filepath + '.part'
+                try:
+                    with requests.get(zfile['links']['download'], headers=headers, stream=True, timeout=300) as r:
+                        if r.status_code >= 300:
+                            self.logger.error('ERR, downloading file via zenodo')
+                            return False
+                        with open(tmppath, 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=1 << 20):
+                                f.write(chunk)
+                    shutil.move(tmppath, filepath)
+                    return True
+                finally:
+                    if os.path.exists(tmppath):
+                        os.remove(tmppath)
+
+        self.logger.error('ERR, file ' + filename + ' not found in deposition ' + str(deposition_id))
+        return False
+
+    # Has the deposition been published (its files can no longer be deleted)
+    def isPublished(self, deposition_id):
+        ret = requests.get('%s/%s' % (self.zapi, deposition_id),
+                           headers={"Authorization": "Bearer %s" % self.ztoken}, timeout=60)
+        if ret.status_code >= 300:
+            self.logger.error('ERR, reading deposition ' + str(deposition_id))
+            return False
+        return ret.json().get('submitted', False)
+
+    # Is file bigger than the threshold (default 99mb) // Zenodo limitations
     def isFileBig(self, fname):
         szMB = os.path.getsize(fname) >> 20
         self.logger.info('The file upload size is:' + str(szMB))
-        if szMB < 99:
+        if szMB < self.bigFileMB:
             return False
         else:
             return True
@@ -70,6 +119,7 @@ class DOI:
                     ret = self.zenodoUploadFile(res_create['links']['files'], os.path.join(self.direc, f))
                 if ret.status_code < 300:  # success
                     self.logger.info('OK, file uploaded on zenodo')
+                    self.uploaded.append(f)
                 else:
                     self.logger.error('ERR, uploading file via zenodo')
                     self.logger.error(ret)
@@ -5,15 +5,19 @@
 # which in turn is based on the jQuery-File-Upload (https://github.com/blueimp/jQuery-File-Upload/)
 
 import os
+import errno
 import simplejson
-from flask import Flask, request, render_template, session, redirect, url_for, flash, send_from_directory
+from flask import Flask, request, render_template, session, redirect, url_for, flash, send_from_directory, make_response, abort
 from flask_bootstrap import Bootstrap
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from functools import wraps
 from lib.upload_file import uploadfile
 import logging
 from logging.handlers import RotatingFileHandler
 import json
 import zipfile
+import shutil
 import time
 import functions
 import threddsclient
@@ -28,6 +32,9 @@ from geoserver.catalog import Catalog
 
 # Specific from app
 from DOI import DOI
+from datasetstate import DatasetState
+from storagemanager import StorageManager
+from datasetsummary import DatasetSummary
 from settings import settings
 
 # used for 'slugify': creating a valid url
@@ -39,6 +46,11 @@ app.config.update(settings)
 
 bootstrap = Bootstrap(app)
 
+# derived artifacts (download all zip files, extracted shapefiles, staged files stored on Zenodo) are evicted
+# when they exceed DERIVED_STORAGE_BUDGET bytes and rebuilt on demand, see storagemanager.py
+storage = StorageManager(app.config['BASE_UPLOAD_FOLDER'], budget=app.config.get('DERIVED_STORAGE_BUDGET'),
+                         stateFolder=app.config.get('DATASET_STATE_FOLDER'), logger=app.logger)
+
 # set up logging
 logFile = os.path.join(my_dir, 'datauploadtool.log')
 file_handler = RotatingFileHandler(logFile, 'a', 1 * 1024 * 1024, 10)
@@ -79,8 +91,9 @@ def gen_file_name(fullpath, filename):
     """
     If file exist already, rename it and return a new name
     """
+    evicted = storage.evictedFiles(fullpath)  # evicted files still belong to the dataset
     i = 1
-    while os.path.exists(os.path.join(fullpath, filename)):
+    while os.path.exists(os.path.join(fullpath, filename)) or filename in evicted:
         name, extension = os.path.splitext(filename)
         filename = '%s_%s%s' % (name, str(i), extension)
         i = i + 1
@@ -88,6 +101,102 @@ def gen_file_name(fullpath, filename):
     return filename
 
 
+def getDatasetState(datasetFoldername):
+    """
+    Returns the shared state of a dataset, stored next to the uploads so that every worker/node sees the same state
+    :param datasetFoldername: the name of the dataset folder
+    :return: DatasetState
+    """
+    return DatasetState(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername,
+                        stateFolder=app.config.get('DATASET_STATE_FOLDER'), logger=app.logger)
+
+
+def getDatasetSummary(datasetFoldername):
+    """
+    Returns the precomputed summary of the files of a dataset, used for the dataset listing
+    :param datasetFoldername: the name of the dataset folder
+    :return: DatasetSummary
+    """
+    return DatasetSummary(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername,
+                          stateFolder=app.config.get('DATASET_STATE_FOLDER'), ignoredFiles=app.config['IGNORED_FILES'],
+                          checksums=app.config.get('DATASET_SUMMARY_CHECKSUMS', False), logger=app.logger)
+
+
+def currentDataset():
+    """
+    Get the dataset of the current session; the cookie only holds the folder name, the rest is read from the shared state.
+    Sessions created before the shared state existed still carry the values in the cookie, these are used as fallback.
+    :return: tuple of the dataset folder name, the dataset name and whether a DOI should be generated
+    """
+    datasetFoldername = session['DATASETFOLDERNAME']
+    state = getDatasetState(datasetFoldername).load()
+    datasetname = state.get('DATASETNAME', session.get('DATASETNAME'))
+    generateDOI = state.get('GENERATEDOI', session.get('GENERATEDOI', False))
+
+    return datasetFoldername, datasetname, generateDOI
+
+
+def servedPath(path):
+    """
+    Full path of a file under the upload folder that may be downloaded
+    :param path: the path relative to the upload folder, as requested
+    :return: None for paths outside the upload folder or inside the dataset state folder
+    """
+    filePath = safe_join(app.config['BASE_UPLOAD_FOLDER'], path)
+    if filePath is None:
+        return None
+
+    # the state holds dataset names and Zenodo deposition ids, it is not published
+    stateDir = os.path.abspath(storage.stateDir)
+    if os.path.abspath(filePath) == stateDir or os.path.abspath(filePath).startswith(stateDir + os.sep):
+        return None
+
+    return filePath
+
+
+def datasetDirectory(datasetFoldername):
+    """
+    Folder of an existing dataset, for dataset names sent by clients; the name is used as given, not rewritten
+    :param datasetFoldername: the name of the dataset folder
+    :return: None for names that are no dataset folder: paths, the dataset state folder, the download all folder
+    """
+    if datasetFoldername in ('', '.', app.config['ZIP_DOWNLOAD_ALL_FOLDER']) or '/' in datasetFoldername or \
+            os.sep in datasetFoldername:
+        return None
+
+    datasetDir = servedPath(datasetFoldername)
+    if datasetDir is None or not os.path.isdir(datasetDir):
+        return None
+
+    return datasetDir
+
+
+def datasetLocked(view):
+    """
+    Decorator that runs a view while holding the lock of the dataset of the current session,
+    so workers/nodes never change the same dataset folder at the same time
+    """
+    @wraps(view)
+    def lockedView(*args, **kwargs):
+        with getDatasetState(session['DATASETFOLDERNAME']).lock():
+            return view(*args, **kwargs)
+
+    return lockedView
+
+
+def datasetInUse(view):
+    """
+    Decorator that runs a view while the files of the dataset of the current session are in use, so none of them
+    are evicted before the view is done with them, also when it works outside the dataset lock
+    """
+    @wraps(view)
+    def inUseView(*args, **kwargs):
+        with getDatasetState(session['DATASETFOLDERNAME']).useLock():
+            return view(*args, **kwargs)
+
+    return inUseView
+
+
 def checkConnection(url, errorMessage):
     """
     This function checks if a server is responsive
@@ -107,6 +216,7 @@ def checkConnection(url, errorMessage):
 
 
 @app.route("/zip", methods=['POST'])
+@datasetLocked
 def zip():
     """
     Zip all the selected files in the list of uploaded files
@@ -145,20 +255,33 @@ def zip():
         if os.path.isfile(zipPath):
             flash("File already exists, please give a different file name.")
             return simplejson.dumps({"Error": "File already exists, please give a different file name."})
-        else:
-            zf = zipfile.ZipFile(zipPath, 'w')
-
-        # write all selected files to the zip file
-        for file in fileList:
-            filePath = '/'.join([datasetDir, file])
-            zf.write(filePath, file)
 
-        zf.close()
+        # selected files may have been evicted; rebuild only those
+        filePaths = ['/'.join([datasetDir, file]) for file in fileList]
+        pinned = [storage.relPath(filePath) for filePath in filePaths]
+        for filePath in filePaths:
+            if not storage.ensure(filePath, locked=True, pinned=pinned):
+                flash("File " + os.path.basename(filePath) + " is not available.")
+                return simplejson.dumps({"Error": "File " + os.path.basename(filePath) + " is not available."})
+
+        zf = zipfile.ZipFile(zipPath, 'w')
+
+        # write all selected files to the zip file, do not leave a half written zip file behind
+        try:
+            for file in fileList:
+                filePath = '/'.join([datasetDir, file])
+                zf.write(filePath, file)
+            zf.close()
+        except:
+            zf.close()
+            os.remove(zipPath)
+            raise
 
         # delete all the original files
         for file in fileList:
             filePath = '/'.join([datasetDir, file])
             os.remove(filePath)
+            storage.forget(filePath)
 
         return simplejson.dumps({"files": filesDict})
 
@@ -168,6 +291,7 @@ def zip():
 
 
 @app.route("/submitfiles", methods=['GET', 'POST'])
+@datasetInUse
 def submitFiles():
     """
     Send the information of the uploaded files to the Open Data Registration Tool as an encoded JSON string in a GET-request
@@ -188,9 +312,7 @@ def submitFiles():
                         "Failed to connect to the geoserver at " + app.config['GEOSERVER'] + \
                                 ". Shapefiles will not be mapped with WMS and can not be downloaded by WFS.")
 
-    datasetname = session['DATASETNAME']
-    datasetFoldername = session['DATASETFOLDERNAME']
-    generateDOI = session['GENERATEDOI']
+    datasetFoldername, datasetname, generateDOI = currentDataset()
 
     if request.form['submitButton'] == 'previous':
         return redirect('/?datasetname=' + datasetFoldername)
@@ -199,8 +321,13 @@ def submitFiles():
 
         datasetDir = os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername)
 
-        files = [f for f in os.listdir(datasetDir) if
-                 os.path.isfile(os.path.join(datasetDir, f)) and f not in app.config['IGNORED_FILES']]
+        # only the steps that change the dataset folder run under the dataset lock, not the calls to
+        # THREDDS/GeoServer/Zenodo
+        with getDatasetState(datasetFoldername).lock():
+            storage.restore(datasetDir)
+
+            files = [f for f in os.listdir(datasetDir) if
+                     os.path.isfile(os.path.join(datasetDir, f)) and f not in app.config['IGNORED_FILES']]
 
         if len(files) > 0:
 
@@ -330,10 +457,11 @@ def submitFiles():
                                 layerName = fileInZipNoExtName
 
                                 # Publish .zipped shapefile on geoserver, no subdirectories
-                                zipFile.extractall(datasetDir)
-                                for root, dirs, files in os.walk(datasetDir):
-                                    for name in files:
-                                        os.rename(os.path.join(root, name), os.path.join(datasetDir,name))
+                                with getDatasetState(datasetFoldername).lock():
+                                    zipFile.extractall(datasetDir)
+                                    for root, dirs, walkFiles in os.walk(datasetDir):
+                                        for name in walkFiles:
+                                            os.rename(os.path.join(root, name), os.path.join(datasetDir,name))
 
                                 # create workspace
                                 r = requests.post(url= app.config['GEOSERVER'] + "/rest/workspaces",
@@ -450,15 +578,35 @@ def submitFiles():
                                 layer._set_default_style(fileInZipNoExtName)
                                 cat.save(layer)
 
+                        # Extracted files are derived from the zip file and can be evicted, except the shapefiles
+                        # that are published: geoserver reads those from the dataset folder
+                        if layerName:
+                            layerNames = [os.path.splitext(os.path.split(fileInZip)[1])[0] for fileInZip in filesInZip
+                                          if os.path.splitext(fileInZip)[1] == '.shp']
+                            for fileInZip in filesInZip:
+                                fileInZipName = os.path.split(fileInZip)[1]
+                                extractedPath = os.path.join(datasetDir, fileInZipName)
+                                if fileInZipName and fileInZipName != file and os.path.isfile(extractedPath) and \
+                                        os.path.splitext(fileInZipName)[0] not in layerNames:
+                                    storage.register(extractedPath, 'shapefile', datasetFoldername, source=file)
+
                         # close zip file after looping through all files in the zip file
                         zipFile.close()
             #endregion
 
             # region
             if generateDOI:
-                d = DOI(files, datasetDir, datasetname, logger=app.logger)
+                d = DOI(files, datasetDir, datasetname, logger=app.logger,
+                        bigFileMB=app.config.get('ZENODO_BIG_FILE_MB', 99))
                 deposition_id = d.runUpload()
 
+                # the staged files become evictable once the deposition is published, see registerPublished;
+                # netCDF files are served by THREDDS from the dataset folder and always stay
+                datasetState = getDatasetState(datasetFoldername)
+                with datasetState.lock():
+                    datasetState.save(DEPOSITION=deposition_id,
+                                      ZENODOFILES=[f for f in d.uploaded if os.path.splitext(f)[1] != '.nc'])
+
             # endregion
             resultString = json.dumps(result)
             text = urllib.quote_plus(resultString.encode('utf-8'))
@@ -477,8 +625,7 @@ def submitFiles():
 @app.route("/uploaddata", methods=['GET', 'POST'])
 def uploadData():
 
-    datasetname = session['DATASETNAME']
-    datasetFoldername = session['DATASETFOLDERNAME']
+    datasetFoldername, datasetname, generateDOI = currentDataset()
 
     return render_template('upload.html', datasetname=datasetname, datasetFoldername=datasetFoldername)
 
@@ -499,15 +646,25 @@ def upload():
         if file:
 
             filename = secure_filename(file.filename)
-            filename = gen_file_name(fullpath, filename)
 
-            try:
+            # claim the file name under the dataset lock by creating the empty file, so parallel uploads never get
+            # the same name; the file itself is saved outside the lock so uploads to one dataset run in parallel
+            with getDatasetState(datasetFoldername).lock():
+                filename = gen_file_name(fullpath, filename)
                 uploaded_file_path = os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername, filename)
+                os.close(os.open(uploaded_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+            try:
                 file.save(uploaded_file_path)
                 size = os.path.getsize(uploaded_file_path)  # get file size after saving
+                if app.config.get('DATASET_SUMMARY_CHECKSUMS', False):
+                    getDatasetSummary(datasetFoldername).recordChecksums([filename])
+                os.utime(fullpath, None)  # mark the dataset as changed now the file is complete, see datasetsummary.py
             except:
                 errorMessage = 'Error saving file: ' + filename + ' to working copy'
                 app.logger.error(errorMessage)
+                if os.path.exists(uploaded_file_path):
+                    os.remove(uploaded_file_path)
                 return simplejson.dumps({"Error: ": errorMessage})
 
             app.logger.info('File: ' + filename + ' saved succesfully in working copy')
@@ -532,6 +689,10 @@ def upload():
             file_saved = uploadfile(name=file, datasetFoldername=datasetFoldername, size=size)
             file_display.append(file_saved.get_file())
 
+        for file, size in storage.evictedFiles(datasetDir).items():
+            file_saved = uploadfile(name=file, datasetFoldername=datasetFoldername, size=size)
+            file_display.append(file_saved.get_file())
+
         return simplejson.dumps({"files": file_display})
 
 
@@ -560,58 +721,113 @@ def createDatasetFolder():
         # create the dataset folder in the folder of the servertype; if name already taken, increment foldername
         fullpath = os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername)
 
+        # creating the folder is the atomic step that claims the name, so workers/nodes never share a folder
         n = 1
         origDatasetFoldername = datasetFoldername
-        while os.path.exists(fullpath):
+        while True:
+            try:
+                os.makedirs(fullpath)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
             datasetFoldername = origDatasetFoldername + str(n)
             fullpath = os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername)
             n += 1
 
-        os.makedirs(fullpath)
         app.logger.info('Dataset will be stored in: ' + fullpath)
 
-        # set cookies (used for page refresh)
-        session['DATASETNAME'] = datasetname
+        # store the dataset state where all workers can read it
+        datasetState = getDatasetState(datasetFoldername)
+        with datasetState.lock():
+            datasetState.save(DATASETNAME=datasetname, GENERATEDOI=generateDOI)
+
+        # set cookie (used for page refresh); only the folder name, the rest is in the shared state
         session['DATASETFOLDERNAME'] = datasetFoldername
-        session['GENERATEDOI'] = generateDOI
 
         return redirect(url_for('uploadData'))
 
 
 @app.route("/data/<datasetFoldername>/")
 def downloadDataset(datasetFoldername):
+    """
+    Listing of the files of a dataset, one page at a time (?page=, ?perpage=), served from the precomputed summary
+    of the dataset. Supports conditional requests: the ETag changes only when the listing changes.
+    :return:
+    """
+    datasetDir = datasetDirectory(datasetFoldername)
+    if datasetDir is None:
+        abort(404)
+
     result = {}
     result['datasetFoldername'] = datasetFoldername
 
-    datasetDir = os.path.join(os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername))
+    summary = getDatasetSummary(datasetFoldername).get(lambda: storage.evictedFiles(datasetDir))  # evicted files are rebuilt when downloaded
+
+    perPage = max(1, request.args.get('perpage', app.config.get('DATASET_PAGE_SIZE', 100), type=int))
+    pages = max(1, (len(summary['files']) + perPage - 1) // perPage)
+    page = min(max(1, request.args.get('page', 1, type=int)), pages)
+
+    etag = '%s-%s-%s' % (summary['etag'], page, perPage)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
 
     fileInfoList = []
-    files = [f for f in os.listdir(datasetDir) if
-             os.path.isfile(os.path.join(datasetDir, f)) and f not in app.config['IGNORED_FILES']]
-    for f in files:
+    for summaryInfo in summary['files'][(page - 1) * perPage:page * perPage]:
         fileInfo = {}
-        fileInfo['size'] = os.path.getsize(os.path.join(datasetDir, f))
+        fileInfo['size'] = summaryInfo['size']
         fileInfo['sizeText'] = functions.formatFileSize(fileInfo['size'])
-        fileInfo['url'] = os.path.join(request.base_url, f)
-        fileInfo['name'] = f
+        fileInfo['url'] = os.path.join(request.base_url, summaryInfo['name'])
+        fileInfo['name'] = summaryInfo['name']
+        if 'md5' in summaryInfo:
+            fileInfo['md5'] = summaryInfo['md5']
 
         fileInfoList.append(fileInfo)
 
     result['files'] = fileInfoList
+    result['fileCount'] = len(summary['files'])
+    result['totalSize'] = summary['totalSize']
+    result['totalSizeText'] = functions.formatFileSize(summary['totalSize'])
+    result['version'] = summary['version']
+    result['page'] = page
+    result['pages'] = pages
+    result['perPage'] = perPage
 
-    return render_template('download.html', result=result)
+    response = make_response(render_template('download.html', result=result))
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/data/<path:path>", methods=['GET'])
 def downloadFile(path):
+    filePath = servedPath(path)
+    if filePath is None:
+        abort(404)
+    storage.ensure(filePath)  # rebuild the file if it has been evicted
     return send_from_directory(os.path.join(app.config['BASE_UPLOAD_FOLDER']), filename=path)
 
 
 @app.route("/downloadallzip/<path:path>", methods=['GET'])
 def downloadallzip(path):
+    filePath = servedPath(path)
+    if filePath is None:
+        abort(404)
+    storage.ensure(filePath)  # rebuild the file if it has been evicted
     return send_from_directory(os.path.join(app.config['BASE_UPLOAD_FOLDER']), filename=path)
 
 
+@app.route("/storage", methods=['GET'])
+def storageUsage():
+    """
+    Usage statistics of the derived artifacts (bytes and counts on disk and evicted, in total and per kind) and the
+    storage budget; primary uploads are not counted, only the artifact index is read
+    :return:
+    """
+    return simplejson.dumps(storage.usage())
+
+
 @app.route("/downloadall", methods=['POST'])
 def downloadAll():
     """
@@ -621,24 +837,45 @@ def downloadAll():
     datasetFoldername = request.form['datasetFoldername']
     zipFilename = "{}.zip".format(datasetFoldername)
 
+    # unknown datasets get no lock file
+    if datasetDirectory(datasetFoldername) is None:
+        abort(404)
+
+    with getDatasetState(datasetFoldername).lock():
+        zipDataset(datasetFoldername, zipFilename)
+
+    downloadPath = '/'.join(["downloadallzip", app.config['ZIP_DOWNLOAD_ALL_FOLDER'], zipFilename])
+    return redirect(downloadPath)
+
+
+def zipDataset(datasetFoldername, zipFilename):
+    """
+    Zip all files of the dataset into the download all folder; the caller must hold the dataset lock
+    :return:
+    """
+
     zipRootFolder = os.path.join(app.config['BASE_UPLOAD_FOLDER'], app.config['ZIP_DOWNLOAD_ALL_FOLDER'])
     if not os.path.exists(zipRootFolder):
-        os.makedirs(zipRootFolder)
-        app.logger.info("Created zip root folder at: " + zipRootFolder)
+        try:
+            os.makedirs(zipRootFolder)
+            app.logger.info("Created zip root folder at: " + zipRootFolder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:  # created by another worker in the meantime
+                raise
 
     zipFilepath = os.path.join(app.config['BASE_UPLOAD_FOLDER'], app.config['ZIP_DOWNLOAD_ALL_FOLDER'], zipFilename)
 
-    # Test if zip file already exists; if yes, remove this .zip file
-    if os.path.exists(zipFilepath):
-        os.remove(zipFilepath)
-
     datasetDir = os.path.join(os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername))
 
+    # evicted files are part of the dataset too
+    storage.restore(datasetDir)
+
     files = [f for f in os.listdir(datasetDir) if
              os.path.isfile(os.path.join(datasetDir, f)) and f not in app.config['IGNORED_FILES']]
 
-    # Open a zip file
-    zf = zipfile.ZipFile(zipFilepath, 'w')
+    # Write to a temporary file and move it in place, so a running download never sees a half written zip file
+    tmpZipFilepath = zipFilepath + '.' + str(os.getpid()) + '.tmp'
+    zf = zipfile.ZipFile(tmpZipFilepath, 'w')
 
     for f in files:
         filename = os.path.join(datasetDir, f)
@@ -646,9 +883,78 @@ def downloadAll():
         zf.write(filename, arcName)
 
     zf.close()
+    os.rename(tmpZipFilepath, zipFilepath)
+    storage.register(zipFilepath, 'downloadall', datasetFoldername)
 
-    downloadPath = '/'.join(["downloadallzip", app.config['ZIP_DOWNLOAD_ALL_FOLDER'], zipFilename])
-    return redirect(downloadPath)
+
+def rebuildDownloadAll(relPath, entry):
+    zipDataset(entry['dataset'], os.path.basename(relPath))
+
+
+def rebuildShapefile(relPath, entry):
+    # extract the file again from the zipped shapefile it came from
+    datasetDir = os.path.join(app.config['BASE_UPLOAD_FOLDER'], entry['dataset'])
+    filename = os.path.basename(relPath)
+    zipFilePath = os.path.join(datasetDir, entry['source'])
+    storage.ensure(zipFilePath, locked=True)  # the zip file itself may be evicted after it was pushed to Zenodo
+    zipFile = zipfile.ZipFile(zipFilePath, 'r')
+    for fileInZip in zipFile.namelist():
+        if os.path.split(fileInZip)[1] == filename:
+            tmpPath = storage.tempFile(filename)
+            try:
+                with open(tmpPath, 'wb') as f:
+                    shutil.copyfileobj(zipFile.open(fileInZip), f)
+                shutil.move(tmpPath, os.path.join(datasetDir, filename))
+            except:
+                os.remove(tmpPath)
+                raise
+            break
+    zipFile.close()
+
+
+def rebuildZenodo(relPath, entry):
+    # download the file again from the Zenodo deposition
+    datasetDir = os.path.join(app.config['BASE_UPLOAD_FOLDER'], entry['dataset'])
+    filename = os.path.basename(relPath)
+    d = DOI([], datasetDir, entry['dataset'], logger=app.logger)
+    tmpPath = storage.tempFile(filename)
+    try:
+        d.zenodoDownloadFile(entry['source'], filename, os.path.join(datasetDir, filename), tmpPath)
+    finally:
+        if os.path.exists(tmpPath):  # not downloaded
+            os.remove(tmpPath)
+
+
+@app.cli.command('registerpublished')
+def registerPublished():
+    """
+    Register the staged files of datasets whose Zenodo deposition has been published as evictable artifacts;
+    run regularly (e.g. from cron: flask registerpublished). Unpublished drafts can be deleted, so until the
+    deposition is published the staged files are the only safe copy and are never evicted.
+    """
+    for datasetFoldername in sorted(os.listdir(app.config['BASE_UPLOAD_FOLDER'])):
+        datasetDir = os.path.join(app.config['BASE_UPLOAD_FOLDER'], datasetFoldername)
+        datasetState = getDatasetState(datasetFoldername)
+        state = datasetState.load()
+        if not os.path.isdir(datasetDir) or not state.get('ZENODOFILES'):
+            continue
+
+        d = DOI([], datasetDir, state.get('DATASETNAME'), logger=app.logger)
+        if not d.isPublished(state['DEPOSITION']):
+            continue
+
+        with datasetState.lock():
+            for f in state['ZENODOFILES']:
+                filePath = os.path.join(datasetDir, f)
+                if os.path.isfile(filePath):
+                    storage.register(filePath, 'zenodo', datasetFoldername, source=state['DEPOSITION'])
+            datasetState.save(ZENODOFILES=[])
+        app.logger.info('Staged files of ' + datasetFoldername + ' registered, deposition ' + str(state['DEPOSITION']) + ' is published')
+
+
+storage.builders['downloadall'] = rebuildDownloadAll
+storage.builders['shapefile'] = rebuildShapefile
+storage.builders['zenodo'] = rebuildZenodo
 
 
 if __name__ == '__main__':
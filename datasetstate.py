@@ -0,0 +1,125 @@
+# Shared dataset state for running the upload tool on several workers/nodes.
+# The state of a dataset (name, DOI flag, ...) is stored as a small JSON file on the shared storage
+# next to the uploads, and every change to a dataset folder is guarded by an advisory lock file.
+
+import os
+import json
+import errno
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+STATE_FOLDER = '.datasetstate'
+
+# lockf locks are held per process, threads of one worker are kept apart by a thread lock per lock file.
+# {lockPath: [thread lock, number of threads holding or waiting]}; entries are removed when no thread uses
+# them any more, so the table does not grow with every dataset ever touched
+threadLocks = {}
+threadLocksGuard = threading.Lock()
+
+
+def makeDirs(path):
+    # Create a folder, it is no error when another worker/node created it first
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+# Exclusive advisory lock on a lock file, shared between all processes using the same storage.
+# lockf (POSIX record locks) is used rather than flock so the lock also holds on NFS mounts.
+# The lock is not reentrant: never take the same lock twice in one thread.
+# With blocking=False it yields False instead of waiting when the lock is taken (also by the calling thread).
+@contextmanager
+def fileLock(lockPath, blocking=True):
+    with threadLocksGuard:
+        entry = threadLocks.setdefault(lockPath, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        threadLock = entry[0]
+        if not threadLock.acquire(blocking):
+            yield False
+            return
+        try:
+            makeDirs(os.path.dirname(lockPath))
+            with open(lockPath, 'a') as lockFile:
+                try:
+                    fcntl.lockf(lockFile, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as e:
+                    if blocking or e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.lockf(lockFile, fcntl.LOCK_UN)
+        finally:
+            threadLock.release()
+    finally:
+        with threadLocksGuard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del threadLocks[lockPath]
+
+
+# Read a JSON file, an empty dict if it does not exist (yet)
+def readJson(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+
+
+# Write a JSON file; the file is replaced atomically so readers never see a partial write
+def writeJson(path, data):
+    folder, name = os.path.split(path)
+    makeDirs(folder)
+    fd, tmpPath = tempfile.mkstemp(dir=folder, prefix=name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpPath, path)
+    except:
+        os.remove(tmpPath)
+        raise
+
+
+class DatasetState:
+    def __init__(self, baseFolder, datasetFoldername, stateFolder=None, logger=None):
+        # Inputs
+        self.dataset = datasetFoldername
+        self.logger = logger
+        if stateFolder is None:
+            stateFolder = os.path.join(baseFolder, STATE_FOLDER)
+        self.stateDir = stateFolder
+        self.statePath = os.path.join(self.stateDir, datasetFoldername + '.json')
+        self.lockPath = os.path.join(self.stateDir, datasetFoldername + '.lock')
+        self.useLockPath = os.path.join(self.stateDir, datasetFoldername + '.use.lock')
+
+    # Exclusive lock on the dataset
+    def lock(self, blocking=True):
+        return fileLock(self.lockPath, blocking=blocking)
+
+    # Lock held while the files of the dataset are used outside the dataset lock (e.g. zipped or uploaded
+    # during a submit); no derived artifacts of the dataset are evicted while it is held
+    def useLock(self, blocking=True):
+        return fileLock(self.useLockPath, blocking=blocking)
+
+    # Read the stored state, an empty dict if the dataset has no state (yet)
+    def load(self):
+        return readJson(self.statePath)
+
+    # Update the stored state; callers hold the dataset lock
+    def save(self, **values):
+        state = self.load()
+        state.update(values)
+        writeJson(self.statePath, state)
+        if self.logger is not None:
+            self.logger.info('Dataset state of ' + self.dataset + ' saved: ' + json.dumps(state))
+        return state
@@ -0,0 +1,189 @@
+# Precomputed summary of the files of a dataset for the /data/<dataset>/ listing pages.
+# The summary is stored next to the dataset state and only regenerated when the dataset folder changed
+# (its modification time), so a listing costs two stats and one small read, whatever the number of files.
+# Checksums are never computed while a listing waits: they are recorded when a file is uploaded, the
+# checksums of other files are computed in the background and show up in the next summary.
+
+import os
+import hashlib
+import threading
+
+from datasetstate import STATE_FOLDER, fileLock, readJson, writeJson
+
+# A summary written within this many seconds of the last change of the folder is not trusted:
+# file systems with a coarse modification time would hide changes made in the same second.
+# Both times are modification times on the file server, so the clocks of the nodes do not matter.
+SETTLE_TIME = 2
+
+# Background checksum jobs of this worker, one per dataset: {datasetDir: filenames still to do}
+hashing = {}
+hashingGuard = threading.Lock()
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DatasetSummary:
+    def __init__(self, baseFolder, datasetFoldername, stateFolder=None, ignoredFiles=(), checksums=False, logger=None):
+        # Inputs
+        self.dataset = datasetFoldername
+        self.datasetDir = os.path.join(baseFolder, datasetFoldername)
+        self.ignored = ignoredFiles
+        self.checksums = checksums
+        self.logger = logger
+        if stateFolder is None:
+            stateFolder = os.path.join(baseFolder, STATE_FOLDER)
+        self.summaryPath = os.path.join(stateFolder, datasetFoldername + '.summary.json')
+        self.lockPath = os.path.join(stateFolder, datasetFoldername + '.summary.lock')
+        self.checksumsPath = os.path.join(stateFolder, datasetFoldername + '.checksums.json')
+        self.checksumsLockPath = os.path.join(stateFolder, datasetFoldername + '.checksums.lock')
+        self.hashingLockPath = os.path.join(stateFolder, datasetFoldername + '.hashing.lock')
+
+    def isCurrent(self, summary, dirMtime):
+        if summary.get('dirMtime') != dirMtime:
+            return False
+        # the summary file is written after the last change of the folder, both on the file server's clock
+        return os.stat(self.summaryPath).st_mtime - dirMtime >= SETTLE_TIME
+
+    # Compute and store the checksums of files of the dataset {filename: ...}; called after an upload,
+    # and in the background for files the summary has no checksum for.
+    # A file that cannot be read is recorded with md5 None, so it is not tried again until it changes.
+    # Returns the number of checksums written.
+    def recordChecksums(self, filenames):
+        checksums = {}
+        for f in filenames:
+            path = os.path.join(self.datasetDir, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed in the meantime
+            try:
+                md5 = md5sum(path)
+            except (IOError, OSError) as e:
+                md5 = None
+                if self.logger is not None:
+                    self.logger.warning('No checksum for ' + path + ': ' + str(e))
+            checksums[f] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}
+        if not checksums:
+            return 0
+        with fileLock(self.checksumsLockPath):
+            stored = readJson(self.checksumsPath)
+            stored.update(checksums)
+            writeJson(self.checksumsPath, stored)
+        return len([c for c in checksums.values() if c['md5'] is not None])
+
+    # Record checksums in a background thread. There is one job per dataset: files asked for while it runs are
+    # added to it, and a job running on another worker/node is left to do the work. The folder is only touched
+    # (so the next listing shows the checksums) when new checksums were written.
+    def recordChecksumsInBackground(self, filenames):
+        with hashingGuard:
+            if self.datasetDir in hashing:
+                hashing[self.datasetDir].update(filenames)
+                return
+            hashing[self.datasetDir] = set(filenames)
+        thread = threading.Thread(target=self.recordPendingChecksums)
+        thread.daemon = True
+        thread.start()
+
+    def recordPendingChecksums(self):
+        written = 0
+        finished = False
+        try:
+            with fileLock(self.hashingLockPath, blocking=False) as locked:
+                while locked:
+                    with hashingGuard:
+                        filenames = hashing[self.datasetDir]
+                        if not filenames:
+                            del hashing[self.datasetDir]
+                            finished = True
+                            break
+                        hashing[self.datasetDir] = set()
+                    written += self.recordChecksums(sorted(filenames))
+        finally:
+            if not finished:  # another worker/node is recording checksums of the dataset, or this job failed
+                with hashingGuard:
+                    del hashing[self.datasetDir]
+        if written:
+            os.utime(self.datasetDir, None)
+
+    # Get the summary of the dataset, regenerated if the dataset folder changed since it was made.
+    # evictedFiles: function returning {filename: size} of evicted files that still belong to the dataset,
+    # only called when the summary is regenerated
+    def get(self, evictedFiles=None):
+        dirMtime = os.stat(self.datasetDir).st_mtime
+        summary = readJson(self.summaryPath)
+        if self.isCurrent(summary, dirMtime):
+            return summary
+
+        # one worker regenerates, the others wait and use its result
+        with fileLock(self.lockPath):
+            summary = readJson(self.summaryPath)
+            dirMtime = os.stat(self.datasetDir).st_mtime
+            if self.isCurrent(summary, dirMtime):
+                return summary
+            evicted = evictedFiles() if evictedFiles is not None else {}
+            summary, missing = self.generate(summary, dirMtime, evicted)
+            if os.stat(self.datasetDir).st_mtime != dirMtime:
+                summary['dirMtime'] = None  # changed while generating, regenerate on the next request
+            writeJson(self.summaryPath, summary)
+
+        if missing:
+            self.recordChecksumsInBackground(missing)
+
+        return summary
+
+    # Returns the summary and the files without a known checksum
+    def generate(self, previous, dirMtime, evicted):
+        # checksums of unchanged files are taken from the recorded checksums or the previous summary
+        previousFiles = dict((fileInfo['name'], fileInfo) for fileInfo in previous.get('files', []))
+        if self.checksums:
+            previousFiles.update(readJson(self.checksumsPath))
+        missing = []
+
+        fileInfoList = []
+        for f in sorted(set(os.listdir(self.datasetDir)) | set(evicted)):
+            path = os.path.join(self.datasetDir, f)
+            if f in self.ignored:
+                continue
+            if f in evicted:
+                fileInfo = {'name': f, 'size': evicted[f], 'mtime': None}
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                fileInfo = {'name': f, 'size': stat.st_size, 'mtime': stat.st_mtime}
+            else:
+                continue
+
+            if self.checksums:
+                old = previousFiles.get(f, {})
+                if 'md5' in old and old['size'] == fileInfo['size'] and \
+                        (fileInfo['mtime'] is None or old['mtime'] == fileInfo['mtime']):
+                    if old['md5'] is not None:  # None: the file could not be read
+                        fileInfo['md5'] = old['md5']
+                elif fileInfo['mtime'] is not None:
+                    missing.append(f)
+            fileInfoList.append(fileInfo)
+
+        # the ETag only depends on what the listing shows, the version goes up when that changes
+        etag = hashlib.sha1()
+        for fileInfo in fileInfoList:
+            etag.update((u'%s\t%s\t%s\n' % (fileInfo['name'], fileInfo['size'], fileInfo.get('md5'))).encode('utf-8'))
+        etag = etag.hexdigest()
+        version = previous.get('version', 0)
+        if etag != previous.get('etag'):
+            version += 1
+
+        summary = {
+            'version': version,
+            'etag': etag,
+            'dirMtime': dirMtime,
+            'totalSize': sum(fileInfo['size'] for fileInfo in fileInfoList),
+            'files': fileInfoList,
+        }
+        if self.logger is not None:
+            self.logger.info('Summary of dataset ' + self.dataset + ' regenerated, version ' + str(summary['version']))
+        return summary, missing
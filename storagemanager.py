@@ -0,0 +1,191 @@
+# Bookkeeping of derived artifacts under BASE_UPLOAD_FOLDER (download all zip files, files extracted from
+# zipped shapefiles, staged files that are already stored on Zenodo). Unlike the primary uploads these can be
+# rebuilt at any time, so they are evicted in least recently used order when they exceed the storage budget
+# and rebuilt on demand when they are requested again.
+
+import os
+import time
+import tempfile
+
+from datasetstate import STATE_FOLDER, DatasetState, fileLock, makeDirs, readJson, writeJson
+
+# Do not rewrite the index for every download of the same artifact
+TOUCH_INTERVAL = 60
+
+
+class StorageManager:
+    def __init__(self, baseFolder, budget=None, stateFolder=None, logger=None):
+        # Inputs
+        self.base = baseFolder
+        self.budget = budget  # bytes, None means unlimited
+        self.logger = logger
+        if stateFolder is None:
+            stateFolder = os.path.join(baseFolder, STATE_FOLDER)
+        self.stateDir = stateFolder
+        self.indexPath = os.path.join(self.stateDir, 'artifacts.json')
+        self.lockPath = os.path.join(self.stateDir, 'artifacts.lock')
+        # Last index read by this worker and the stat of the index file it was read from
+        self.cachedIndex = (None, {})
+        # Functions to rebuild an artifact, per kind: builder(relPath, entry)
+        self.builders = {}
+
+    def relPath(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.base))
+
+    def fullPath(self, relPath):
+        return os.path.join(self.base, relPath)
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    # The index for lookups, only parsed again when the index file changed (it is replaced on every write);
+    # downloads only cost a stat of the index. The result is shared, do not change it: changes are made under
+    # the index lock on an index read with readJson.
+    def readIndex(self):
+        try:
+            stat = os.stat(self.indexPath)
+        except OSError:
+            return {}
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        cachedKey, index = self.cachedIndex
+        if key != cachedKey:
+            index = readJson(self.indexPath)
+            self.cachedIndex = (key, index)
+        return index
+
+    # New empty temporary file for a rebuild, in the state folder so a failed rebuild leaves nothing in the dataset
+    def tempFile(self, name):
+        makeDirs(self.stateDir)
+        fd, tmpPath = tempfile.mkstemp(dir=self.stateDir, prefix=name, suffix='.tmp')
+        os.close(fd)
+        return tmpPath
+
+    # Start tracking (or refresh) a derived artifact that has just been written.
+    # pinned: paths (relative to the base folder) that must not be evicted to make room for it
+    def register(self, path, kind, dataset, source=None, pinned=()):
+        relPath = self.relPath(path)
+        with fileLock(self.lockPath):
+            index = readJson(self.indexPath)
+            index[relPath] = {
+                'kind': kind,
+                'dataset': dataset,
+                'source': source,
+                'size': os.path.getsize(path),
+                'lastAccess': time.time(),
+                'evicted': False,
+            }
+            self.evict(index, pinned=set(pinned) | set([relPath]))
+            writeJson(self.indexPath, index)
+
+    # Stop tracking a file, e.g. because it was removed or replaced by a primary upload
+    def forget(self, path):
+        relPath = self.relPath(path)
+        with fileLock(self.lockPath):
+            index = readJson(self.indexPath)
+            if index.pop(relPath, None) is not None:
+                writeJson(self.indexPath, index)
+
+    # Mark an artifact as recently used
+    def touch(self, path):
+        relPath = self.relPath(path)
+        entry = self.readIndex().get(relPath)
+        if entry is None or time.time() - entry['lastAccess'] < TOUCH_INTERVAL:
+            return
+        with fileLock(self.lockPath):
+            index = readJson(self.indexPath)
+            if relPath in index:
+                index[relPath]['lastAccess'] = time.time()
+                writeJson(self.indexPath, index)
+
+    # Make sure a tracked artifact exists on disk, rebuild it if it was evicted; returns False if it cannot be provided.
+    # Rebuilding happens under the lock of the dataset, pass locked=True when the caller already holds it.
+    def ensure(self, path, locked=False, pinned=()):
+        relPath = self.relPath(path)
+        entry = self.readIndex().get(relPath)
+        if entry is None:
+            return os.path.isfile(path)
+        if not entry['evicted'] and os.path.isfile(path):
+            self.touch(path)
+            return True
+
+        if not locked:
+            with DatasetState(self.base, entry['dataset'], stateFolder=self.stateDir).lock():
+                return self.ensure(path, locked=True, pinned=pinned)
+
+        builder = self.builders.get(entry['kind'])
+        if builder is None:
+            return False
+        self.log('Rebuilding evicted ' + entry['kind'] + ' artifact: ' + relPath)
+        builder(relPath, entry)
+        if not os.path.isfile(path):
+            return False
+        self.register(path, entry['kind'], entry['dataset'], source=entry['source'], pinned=pinned)
+        return True
+
+    # Rebuild all evicted artifacts of a dataset folder; the caller holds the dataset lock.
+    # None of the files of the dataset are evicted while it is being restored, also when they exceed the budget.
+    def restore(self, datasetDir):
+        folder = self.relPath(datasetDir)
+        pinned = [relPath for relPath in self.readIndex() if os.path.dirname(relPath) == folder]
+        for name in self.evictedFiles(datasetDir):
+            self.ensure(os.path.join(datasetDir, name), locked=True, pinned=pinned)
+
+    # Remove least recently used artifacts until the total size fits in the budget; the caller holds the index lock.
+    # Artifacts of a dataset that is locked or in use (by another request, or by the caller) are skipped.
+    def evict(self, index, pinned=()):
+        if self.budget is None:
+            return
+        present = [(entry['lastAccess'], relPath) for relPath, entry in index.items() if not entry['evicted']]
+        total = sum(index[relPath]['size'] for lastAccess, relPath in present)
+        for lastAccess, relPath in sorted(present):
+            if total <= self.budget:
+                break
+            if relPath in pinned:
+                continue
+            entry = index[relPath]
+            datasetState = DatasetState(self.base, entry['dataset'], stateFolder=self.stateDir)
+            with datasetState.lock(blocking=False) as locked, datasetState.useLock(blocking=False) as unused:
+                if not locked or not unused:
+                    continue
+                try:
+                    os.remove(self.fullPath(relPath))
+                except OSError:
+                    pass  # already removed; rebuilt on demand like any evicted artifact
+            entry['evicted'] = True
+            total -= entry['size']
+            self.log('Evicted ' + entry['kind'] + ' artifact: ' + relPath)
+
+    # Evicted artifacts of a dataset folder, {filename: size}; they still belong to the dataset listing
+    def evictedFiles(self, datasetDir):
+        folder = self.relPath(datasetDir)
+        result = {}
+        for relPath, entry in self.readIndex().items():
+            if entry['evicted'] and os.path.dirname(relPath) == folder:
+                result[os.path.basename(relPath)] = entry['size']
+        return result
+
+    # Usage statistics of the derived artifacts, per kind; only the index is read
+    def usage(self):
+        index = self.readIndex()
+        stats = {
+            'budget': self.budget,
+            'derivedBytes': 0,
+            'derivedCount': 0,
+            'evictedBytes': 0,
+            'evictedCount': 0,
+            'kinds': {},
+        }
+        for relPath, entry in index.items():
+            kind = stats['kinds'].setdefault(entry['kind'], {'bytes': 0, 'count': 0, 'evicted': 0})
+            if entry['evicted']:
+                stats['evictedBytes'] += entry['size']
+                stats['evictedCount'] += 1
+                kind['evicted'] += 1
+            else:
+                stats['derivedBytes'] += entry['size']
+                stats['derivedCount'] += 1
+                kind['bytes'] += entry['size']
+                kind['count'] += 1
+
+        return stats
@@ -0,0 +1,194 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import datasetsummary
+from datasetsummary import DatasetSummary
+
+
+class DatasetSummaryTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.datasetDir = os.path.join(self.base, 'ds')
+        os.makedirs(self.datasetDir)
+        self.md5sum = datasetsummary.md5sum
+
+    def tearDown(self):
+        self.waitForChecksums()
+        datasetsummary.md5sum = self.md5sum
+        shutil.rmtree(self.base)
+
+    def summary(self, checksums=True):
+        return DatasetSummary(self.base, 'ds', checksums=checksums)
+
+    def write(self, name, content='x'):
+        with open(os.path.join(self.datasetDir, name), 'w') as f:
+            f.write(content)
+
+    # Set the modification time of the dataset folder in the past, so a summary written now is trusted
+    def age(self, seconds=10):
+        mtime = int(time.time()) - seconds
+        os.utime(self.datasetDir, (mtime, mtime))
+        return mtime
+
+    def waitForChecksums(self):
+        for i in range(500):
+            with datasetsummary.hashingGuard:
+                if not datasetsummary.hashing:
+                    return
+            time.sleep(0.01)
+        self.fail('checksums still being recorded')
+
+    # Count the summaries generated by a DatasetSummary
+    def counted(self, summary):
+        generated = []
+        generate = summary.generate
+
+        def countingGenerate(*args):
+            generated.append(args)
+            return generate(*args)
+        summary.generate = countingGenerate
+        return generated
+
+    def testRegeneratedWhenFolderChanges(self):
+        self.write('a')
+        self.age()
+        self.assertEqual([fileInfo['name'] for fileInfo in self.summary().get()['files']], ['a'])
+        self.write('b')
+        self.assertEqual([fileInfo['name'] for fileInfo in self.summary().get()['files']], ['a', 'b'])
+
+    def testReusedWhenUnchanged(self):
+        self.write('a')
+        self.age()
+        summary = self.summary()
+        generated = self.counted(summary)
+        first = summary.get()
+        self.assertEqual(summary.get(), first)
+        self.assertEqual(self.summary().get(), first)
+        self.assertEqual(len(generated), 1)
+
+    def testNotTrustedWithinSettleTime(self):
+        self.write('a')
+        summary = self.summary(checksums=False)
+        generated = self.counted(summary)
+        summary.get()
+        summary.get()
+        self.assertEqual(len(generated), 2)
+
+    def testVersionChangesWithListingOnly(self):
+        self.write('a')
+        self.age()
+        first = self.summary().get()
+        # changed folder, same listing
+        self.age(20)
+        second = self.summary().get()
+        self.assertNotEqual(second['dirMtime'], first['dirMtime'])
+        self.assertEqual((second['etag'], second['version']), (first['etag'], first['version']))
+        self.write('b', 'yy')
+        self.age()
+        third = self.summary(checksums=False).get()
+        self.assertNotEqual(third['etag'], first['etag'])
+        self.assertEqual(third['version'], first['version'] + 1)
+        self.assertEqual(third['totalSize'], 3)
+
+    def testEvictedFilesListed(self):
+        self.write('a')
+        self.age()
+        summary = self.summary().get(lambda: {'b': 5})
+        self.assertEqual([(fileInfo['name'], fileInfo['size']) for fileInfo in summary['files']], [('a', 1), ('b', 5)])
+        self.assertEqual(summary['totalSize'], 6)
+
+    def testRecordedChecksumsReused(self):
+        self.write('a')
+        self.summary().recordChecksums(['a'])
+        md5 = self.md5sum(os.path.join(self.datasetDir, 'a'))
+
+        def failingMd5sum(path):
+            raise AssertionError('checksum computed again')
+        datasetsummary.md5sum = failingMd5sum
+        self.age()
+        self.assertEqual(self.summary().get()['files'][0]['md5'], md5)
+        # also once the file has been evicted
+        os.remove(os.path.join(self.datasetDir, 'a'))
+        self.age(20)
+        self.assertEqual(self.summary().get(lambda: {'a': 1})['files'][0]['md5'], md5)
+
+    def testChecksumInvalidatedWhenFileChanges(self):
+        self.write('a')
+        self.summary().recordChecksums(['a'])
+        self.write('a', 'changed')
+        dirMtime = self.age()
+        summary = self.summary().get()
+        self.assertNotIn('md5', summary['files'][0])
+        # computed in the background, the folder is touched so the next listing shows it
+        self.waitForChecksums()
+        self.assertNotEqual(os.stat(self.datasetDir).st_mtime, dirMtime)
+        summary = self.summary().get()
+        self.assertEqual(summary['files'][0]['md5'], self.md5sum(os.path.join(self.datasetDir, 'a')))
+        self.assertEqual(summary['version'], 2)
+
+    def testUnreadableFileIsNotHashedAgain(self):
+        calls = []
+
+        def failingMd5sum(path):
+            calls.append(path)
+            raise IOError('unreadable')
+        datasetsummary.md5sum = failingMd5sum
+
+        self.write('a')
+        dirMtime = self.age()
+        summary = self.summary().get()
+        self.waitForChecksums()
+        self.assertEqual(len(calls), 1)
+        self.assertNotIn('md5', summary['files'][0])
+        # nothing new was recorded, so the folder is not touched and the summary stays current
+        self.assertEqual(os.stat(self.datasetDir).st_mtime, dirMtime)
+        self.assertEqual(self.summary().get(), summary)
+
+        # a regenerated summary knows the file could not be read, no new job is started
+        self.age(20)
+        summary = self.summary().get()
+        self.assertNotIn('md5', summary['files'][0])
+        with datasetsummary.hashingGuard:
+            self.assertEqual(datasetsummary.hashing, {})
+        self.assertEqual(len(calls), 1)
+
+    def testOneChecksumJobPerDataset(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slowMd5sum(path):
+            calls.append(os.path.basename(path))
+            started.set()
+            release.wait(5)
+            return self.md5sum(path)
+        datasetsummary.md5sum = slowMd5sum
+
+        self.write('a')
+        self.write('b')
+        dirMtime = self.age()
+        summary = self.summary()
+        summary.recordChecksumsInBackground(['a'])
+        started.wait(5)
+        summary.recordChecksumsInBackground(['b'])
+        summary.recordChecksumsInBackground(['a'])  # changed in the meantime
+        with datasetsummary.hashingGuard:
+            self.assertEqual(datasetsummary.hashing, {self.datasetDir: set(['a', 'b'])})  # left to the running job
+        release.set()
+        self.waitForChecksums()
+
+        self.assertEqual(sorted(calls), ['a', 'a', 'b'])
+        self.assertNotEqual(os.stat(self.datasetDir).st_mtime, dirMtime)
+        md5 = self.md5sum(os.path.join(self.datasetDir, 'a'))
+        self.assertEqual([fileInfo.get('md5') for fileInfo in self.summary().get()['files']], [md5, md5])
+
+
+if __name__ == '__main__':
+    unittest.main()
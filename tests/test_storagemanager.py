@@ -0,0 +1,170 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import storagemanager
+from datasetstate import DatasetState
+from storagemanager import StorageManager
+
+
+class StorageManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.base, 'ds'))
+        os.makedirs(os.path.join(self.base, 'other'))
+        self.storage = StorageManager(self.base, budget=250)
+        self.built = []
+        self.storage.builders['test'] = self.build
+        self.touchInterval = storagemanager.TOUCH_INTERVAL
+        storagemanager.TOUCH_INTERVAL = 0
+
+    def tearDown(self):
+        storagemanager.TOUCH_INTERVAL = self.touchInterval
+        shutil.rmtree(self.base)
+
+    def build(self, relPath, entry):
+        self.built.append(relPath)
+        self.write(relPath)
+
+    def write(self, relPath, size=100):
+        path = os.path.join(self.base, relPath)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        return path
+
+    def add(self, relPath, dataset='ds', size=100):
+        path = self.write(relPath, size)
+        self.storage.register(path, 'test', dataset)
+        time.sleep(0.01)  # distinct access times
+        return path
+
+    def onDisk(self, folder='ds'):
+        return sorted(os.listdir(os.path.join(self.base, folder)))
+
+    def testRegisterEvictsLeastRecentlyUsed(self):
+        self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        self.assertEqual(self.onDisk(), ['b', 'c'])
+        self.assertEqual(self.storage.evictedFiles(os.path.join(self.base, 'ds')), {'a': 100})
+
+    def testTouchKeepsArtifact(self):
+        a = self.add('ds/a')
+        self.add('ds/b')
+        self.storage.touch(a)
+        time.sleep(0.01)
+        self.add('ds/c')
+        self.assertEqual(self.onDisk(), ['a', 'c'])
+
+    def testRegisterKeepsArtifactLargerThanBudget(self):
+        self.add('ds/a', size=300)
+        self.assertEqual(self.onDisk(), ['a'])
+
+    def testNoBudget(self):
+        self.storage.budget = None
+        for name in 'abcd':
+            self.add('ds/' + name)
+        self.assertEqual(self.onDisk(), ['a', 'b', 'c', 'd'])
+
+    def testEnsureRebuildsEvicted(self):
+        a = self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        self.assertTrue(self.storage.ensure(a))
+        self.assertEqual(self.built, [os.path.join('ds', 'a')])
+        # the dataset is locked while it is rebuilt, so none of its files make room
+        self.assertEqual(self.onDisk(), ['a', 'b', 'c'])
+        # the next artifact brings the total back within the budget, the rebuilt file is the most recently used
+        self.add('other/d', dataset='other')
+        self.assertEqual(self.onDisk(), ['a'])
+        self.assertEqual(self.storage.evictedFiles(os.path.join(self.base, 'ds')), {'b': 100, 'c': 100})
+
+    def testEnsurePresentOrUntracked(self):
+        a = self.add('ds/a')
+        self.assertTrue(self.storage.ensure(a))
+        self.assertTrue(self.storage.ensure(self.write('ds/primary')))
+        self.assertFalse(self.storage.ensure(os.path.join(self.base, 'ds', 'missing')))
+        self.assertEqual(self.built, [])
+
+    def testEnsureWithoutBuilder(self):
+        a = self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        del self.storage.builders['test']
+        self.assertFalse(self.storage.ensure(a))
+
+    def testRestoreKeepsWholeDataset(self):
+        self.storage.budget = 150
+        self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        self.assertEqual(self.onDisk(), ['c'])
+        self.storage.restore(os.path.join(self.base, 'ds'))
+        self.assertEqual(self.onDisk(), ['a', 'b', 'c'])
+        self.assertEqual(self.storage.evictedFiles(os.path.join(self.base, 'ds')), {})
+
+    def testEvictSkipsLockedDataset(self):
+        self.add('ds/a')
+        self.add('ds/b')
+        with DatasetState(self.base, 'ds', stateFolder=self.storage.stateDir).lock():
+            self.add('other/c', dataset='other')
+            self.add('other/d', dataset='other')
+        self.assertEqual(self.onDisk('ds'), ['a', 'b'])
+        self.assertEqual(self.onDisk('other'), ['d'])
+
+    def testEvictSkipsDatasetInUse(self):
+        self.add('ds/a')
+        self.add('ds/b')
+        with DatasetState(self.base, 'ds', stateFolder=self.storage.stateDir).useLock():
+            self.add('other/c', dataset='other')
+        self.assertEqual(self.onDisk('ds'), ['a', 'b'])
+        # no longer in use, the oldest artifacts make room again
+        self.add('other/d', dataset='other')
+        self.assertEqual(self.onDisk('ds'), [])
+        self.assertEqual(self.onDisk('other'), ['c', 'd'])
+
+    def testIndexParsedOnlyWhenChanged(self):
+        a = self.add('ds/a')
+        reads = []
+        readJson = storagemanager.readJson
+        storagemanager.readJson = lambda path: reads.append(path) or readJson(path)
+        try:
+            storagemanager.TOUCH_INTERVAL = 60
+            self.assertTrue(self.storage.ensure(a))
+            count = len(reads)
+            for i in range(3):
+                self.assertTrue(self.storage.ensure(a))
+            self.assertEqual(len(reads), count)
+            # a changed index is read again
+            self.storage.forget(a)
+            self.assertEqual(self.storage.usage()['derivedCount'], 0)
+        finally:
+            storagemanager.readJson = readJson
+
+    def testForget(self):
+        a = self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        self.storage.forget(a)
+        self.assertEqual(self.storage.evictedFiles(os.path.join(self.base, 'ds')), {})
+        self.assertFalse(self.storage.ensure(a))
+
+    def testUsage(self):
+        self.add('ds/a')
+        self.add('ds/b')
+        self.add('ds/c')
+        self.write('ds/primary')
+        usage = self.storage.usage()
+        self.assertEqual(usage['budget'], 250)
+        self.assertEqual((usage['derivedBytes'], usage['derivedCount']), (200, 2))
+        self.assertEqual((usage['evictedBytes'], usage['evictedCount']), (100, 1))
+        self.assertEqual(usage['kinds']['test'], {'bytes': 200, 'count': 2, 'evicted': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()